@@ -0,0 +1,5 @@
+""" Constants shared by the trackball drag path and its compiled kernels. """
+import math
+
+# Radius factor where the deformed trackball switches from sphere to hyperbola
+INV_SQRT2 = 1.0 / math.sqrt(2.0)
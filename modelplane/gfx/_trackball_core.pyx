@@ -0,0 +1,75 @@
+# cython: language_level=3, cdivision=True
+""" Cython build of the virtual trackball drag kernel.
+
+Same interface and arithmetic as the Numba kernel in _trackball_jit, for
+deployments without Numba. The trackball only imports a prebuilt extension,
+built from the repository root with:
+
+    CFLAGS="-O3 -march=native" cythonize -i modelplane/gfx/_trackball_core.pyx
+
+Setting MODELPLANE_BUILD_CYTHON=1 instead builds it with pyximport on first
+import, using the flags in _trackball_core.pyxbld.
+"""
+from libc.math cimport asin, cos, fabs, sin, sqrt
+
+from modelplane.gfx._trackball_constants import INV_SQRT2
+
+cdef double _INV_SQRT2 = INV_SQRT2
+
+
+cdef inline double _project(double r, double x, double y):
+    cdef double d = sqrt(x * x + y * y)
+    cdef double t = r * _INV_SQRT2
+    if d < t:                               # Inside sphere
+        return sqrt(r * r - d * d)
+    return t * t / d                        # On hyperbola
+
+
+cpdef tuple drag_step(double rx, double ry, double rz, double rw,
+                      double x, double y, double dx, double dy,
+                      double tbsize, double inv_2tb, double tolerance):
+    """ Rotate quaternion rx,ry,rz,rw by the drag from x,y to x+dx,y+dy and
+        return the new quaternion.
+    """
+
+    cdef double qx = 0.0, qy = 0.0, qz = 0.0, qw = 1.0
+    cdef double lz, nx, ny, nz, ax, ay, az, dz, t, half, s, n
+    cdef double x2 = rx, y2 = ry, z2 = rz, w2 = rw
+
+    # Drag rotation quaternion, see _fused_drag
+    if dx != 0.0 or dy != 0.0:
+        lz = _project(tbsize, x, y)
+        nx = x + dx
+        ny = y + dy
+        nz = _project(tbsize, nx, ny)
+        ax = ny * lz - nz * y
+        ay = nz * x - nx * lz
+        az = nx * y - ny * x
+        dz = lz - nz
+        t = sqrt(dx * dx + dy * dy + dz * dz) * inv_2tb
+        if t > 1.0:
+            t = 1.0
+        if t < -1.0:
+            t = -1.0
+        half = asin(t)
+        s = sin(half)
+        n = sqrt(ax * ax + ay * ay + az * az)
+        if n != 0.0:
+            s /= n
+        qx, qy, qz, qw = ax * s, ay * s, az * s, cos(half)
+
+    # Compose with the current rotation, see _q_add
+    rx = qw * x2 + qx * w2 + y2 * qz - z2 * qy
+    ry = qw * y2 + qy * w2 + z2 * qx - x2 * qz
+    rz = 0.0
+    rw = qw * w2 - qx * x2 - qy * y2 - qz * z2
+
+    # Drift correction, see _fused_drag
+    n = rx * rx + ry * ry + rw * rw
+    if fabs(n - 1.0) > tolerance:
+        s = 1.5 - 0.5 * n
+        rx *= s
+        ry *= s
+        rw *= s
+
+    return rx, ry, rz, rw
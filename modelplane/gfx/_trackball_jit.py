@@ -0,0 +1,68 @@
+""" Numba compiled kernel for the virtual trackball drag path.
+
+The kernel mirrors _fused_drag in trackball.py so the quaternion update of a
+whole drag event runs as native code. Importing this module raises
+ImportError when Numba is not installed; the trackball then falls back to
+_fused_drag.
+"""
+import math
+
+from numba import njit
+
+from modelplane.gfx._trackball_constants import INV_SQRT2
+
+
+@njit(cache=True, fastmath=True)
+def _project(r, x, y):
+    d = math.sqrt(x * x + y * y)
+    t = r * INV_SQRT2
+    if d < t:                               # Inside sphere
+        return math.sqrt(r * r - d * d)
+    return t * t / d                        # On hyperbola
+
+
+@njit(cache=True, fastmath=True)
+def drag_step(rx, ry, rz, rw, x, y, dx, dy, tbsize, inv_2tb, tolerance):
+    """ Rotate quaternion rx,ry,rz,rw by the drag from x,y to x+dx,y+dy and
+        return the new quaternion.
+    """
+
+    # Drag rotation quaternion, see _fused_drag
+    qx, qy, qz, qw = 0.0, 0.0, 0.0, 1.0
+    if dx != 0.0 or dy != 0.0:
+        lz = _project(tbsize, x, y)
+        nx = x + dx
+        ny = y + dy
+        nz = _project(tbsize, nx, ny)
+        ax = ny * lz - nz * y
+        ay = nz * x - nx * lz
+        az = nx * y - ny * x
+        dz = lz - nz
+        t = math.sqrt(dx * dx + dy * dy + dz * dz) * inv_2tb
+        if t > 1.0:
+            t = 1.0
+        if t < -1.0:
+            t = -1.0
+        half = math.asin(t)
+        s = math.sin(half)
+        n = math.sqrt(ax * ax + ay * ay + az * az)
+        if n != 0.0:
+            s /= n
+        qx, qy, qz, qw = ax * s, ay * s, az * s, math.cos(half)
+
+    # Compose with the current rotation, see _q_add
+    x2, y2, z2, w2 = rx, ry, rz, rw
+    rx = qw * x2 + qx * w2 + y2 * qz - z2 * qy
+    ry = qw * y2 + qy * w2 + z2 * qx - x2 * qz
+    rz = 0.0
+    rw = qw * w2 - qx * x2 - qy * y2 - qz * z2
+
+    # Drift correction, see _fused_drag
+    n = rx * rx + ry * ry + rw * rw
+    if abs(n - 1.0) > tolerance:
+        s = 1.5 - 0.5 * n
+        rx *= s
+        ry *= s
+        rw *= s
+
+    return rx, ry, rz, rw
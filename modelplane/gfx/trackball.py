@@ -16,6 +16,7 @@ Example usage:
    @window.event
    def on_resize(width,height):
        glViewport(0, 0, window.width, window.height)
+       trackball.set_viewport(window.width, window.height)
        glMatrixMode(GL_PROJECTION)
        glLoadIdentity()
        gluPerspective(45, window.width / float(window.height), .1, 1000)
@@ -28,144 +29,238 @@ You can also set trackball orientation directly by setting theta and phi value
 expressed in degrees. Theta relates to the rotation angle around X axis while
 phi relates to the rotation angle around Z axis.
 
+The trackball does not query the GL viewport itself: call set_viewport whenever
+the window is resized so drag_to, zoom_to and push map window coordinates
+correctly.
+
 """
 __docformat__ = 'restructuredtext'
 __version__ = '1.0'
 
+import ctypes
 import math
+import os
+import struct
+import warnings
 import OpenGL.GL as gl
 from OpenGL.GL import GLfloat
 
+from modelplane.gfx._trackball_constants import INV_SQRT2 as _INV_SQRT2
 
-# Some useful functions on vectors
-# -----------------------------------------------------------------------------
-def _v_add(v1, v2):
-    return [v1[0] + v2[0], v1[1] + v2[1], v1[2] + v2[2]]
-
-
-def _v_sub(v1, v2):
-    return [v1[0] - v2[0], v1[1] - v2[1], v1[2] - v2[2]]
-
-
-def _v_mul(v, s):
-    return [v[0] * s, v[1] * s, v[2] * s]
-
-
-def _v_dot(v1, v2):
-    return v1[0] * v2[0] + v1[1] * v2[1] + v1[2] * v2[2]
-
+_DEG2RAD = math.pi / 180.0
+_RAD2DEG = 180.0 / math.pi
+# Largest tolerated | |q|^2 - 1 | before the rotation is pulled back to unit
+_RENORM_TOLERANCE = 1e-6
+# Radius of the virtual trackball
+_TRACKBALLSIZE = 0.8
+# Drags (x, y, dx, dy) a compiled kernel must reproduce before it is used: a
+# no-op, one inside the sphere, one onto the hyperbola and one far outside
+_AGREEMENT_DRAGS = ((0.0, 0.0, 0.0, 0.0), (0.1, -0.2, 0.05, 0.03),
+                    (0.4, 0.3, 0.3, 0.2), (-1.5, 1.2, -0.1, 0.4))
 
-def _v_cross(v1, v2):
-    return [(v1[1] * v2[2]) - (v1[2] * v2[1]),
-            (v1[2] * v2[0]) - (v1[0] * v2[2]),
-            (v1[0] * v2[1]) - (v1[1] * v2[0])]
 
+def _compiled_drag_step():
+    """ Return the Cython drag kernel, else the Numba one, else None when
+        neither is available. A kernel that is missing is skipped quietly,
+        one that fails to build or run is skipped with a warning.
 
-def _v_length(v):
-    return math.sqrt(_v_dot(v, v))
+        The Cython kernel is only used when it has been built ahead of time,
+        see _trackball_core.pyx. Setting MODELPLANE_BUILD_CYTHON=1 opts in to
+        compiling it with pyximport on import instead.
+    """
 
-
-def _v_normalize(v):
     try:
-        return _v_mul(v, 1.0 / _v_length(v))
-    except ZeroDivisionError:
-        return v
+        if os.environ.get('MODELPLANE_BUILD_CYTHON'):
+            import pyximport
+            importers = pyximport.install()
+            try:
+                from modelplane.gfx._trackball_core import drag_step
+            finally:
+                pyximport.uninstall(*importers)
+        else:
+            from modelplane.gfx._trackball_core import drag_step
+        if _agrees_with_fused(drag_step):
+            return drag_step
+    except ImportError:
+        pass
+    except Exception as e:
+        warnings.warn(f'Cython drag kernel failed, not using it: {e!r}')
+    try:
+        from modelplane.gfx._trackball_jit import drag_step
+        if _agrees_with_fused(drag_step):
+            return drag_step
+    except ImportError:
+        pass
+    except Exception as e:
+        warnings.warn(f'Numba drag kernel failed, not using it: {e!r}')
+    return None
+
+
+def _agrees_with_fused(drag_step):
+    """ Check that a compiled kernel follows _fused_drag over
+        _AGREEMENT_DRAGS, warning and returning False when it does not.
+    """
+
+    inv_2tb = 1.0 / (2.0 * _TRACKBALLSIZE)
+    expected = got = (0.3, -0.2, 0.1, 0.9)
+    for x, y, dx, dy in _AGREEMENT_DRAGS:
+        expected = _fused_drag(*expected, x, y, dx, dy, _TRACKBALLSIZE, inv_2tb,
+                               _RENORM_TOLERANCE)
+        got = drag_step(*got, x, y, dx, dy, _TRACKBALLSIZE, inv_2tb,
+                        _RENORM_TOLERANCE)
+        if any(abs(a - b) > 1e-9 for a, b in zip(expected, got)):
+            warnings.warn(f'{drag_step.__module__}.drag_step disagrees with _fused_drag, not using it')
+            return False
+    return True
 
 
 # Some useful functions on quaternions
 # -----------------------------------------------------------------------------
-def _q_add(q1, q2):
-    t1 = _v_mul(q1, q2[3])
-    t2 = _v_mul(q2, q1[3])
-    t3 = _v_cross(q2, q1)
-    tf = _v_add(t1, t2)
-    tf = _v_add(t3, tf)
-    tf.append(q1[3] * q2[3] - _v_dot(q1, q2))
-    return tf
-
-
-def _q_mul(q, s):
-    return [q[0] * s, q[1] * s, q[2] * s, q[3] * s]
-
-
-def _q_dot(q1, q2):
-    return q1[0] * q2[0] + q1[1] * q2[1] + q1[2] * q2[2] + q1[3] * q2[3]
+# Quaternions and vectors are passed around as bare floats (x,y,z,w) so the
+# hot path never builds or indexes a container.
+def _q_add(x1, y1, z1, w1, x2, y2, z2, w2):
+    """ Compose q1 and q2 with a closed-form Hamilton product. """
+    return (w1 * x2 + x1 * w2 + y2 * z1 - z2 * y1,
+            w1 * y2 + y1 * w2 + z2 * x1 - x2 * z1,
+            w1 * z2 + z1 * w2 + x2 * y1 - y2 * x1,
+            w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2)
+
+
+def _q_rotmatrix(x, y, z, w):
+    x2, y2, z2 = x + x, y + y, z + z
+    xx, xy, xz = x * x2, x * y2, x * z2
+    yy, yz, zz = y * y2, y * z2, z * z2
+    wx, wy, wz = w * x2, w * y2, w * z2
+    return (1.0 - (yy + zz), xy - wz, xz + wy, 0.0,
+            xy + wz, 1.0 - (zz + xx), yz - wx, 0.0,
+            xz - wy, yz + wx, 1.0 - (yy + xx), 0.0,
+            0.0, 0.0, 0.0, 1.0)
+
+
+# Trackball projection and drag
+# -----------------------------------------------------------------------------
+def _project(r, x, y):
+    """ Project an x,y pair onto a sphere of radius r OR a hyperbolic sheet
+        if we are away from the center of the sphere.
+    """
+
+    d = math.sqrt(x * x + y * y)
+    t = r * _INV_SQRT2
+    if d < t:                               # Inside sphere
+        z = math.sqrt(r * r - d * d)
+    else:                                   # On hyperbola
+        z = t * t / d
+    return z
+
+
+def _fused_drag(rx, ry, rz, rw, x, y, dx, dy, tbsize, inv_2tb, tolerance):
+    """ Rotate quaternion rx,ry,rz,rw by the drag from x,y to x+dx,y+dy and
+        return the new quaternion, in one pass over bare floats. inv_2tb is
+        the precomputed 1 / (2 * tbsize).
+
+        Project the points onto the virtual trackball, then figure out the
+        axis of rotation, which is the cross product of x,y and x+dx,y+dy.
+        The drag rotation is composed with the current one, the z component
+        is zeroed and norm drift beyond `tolerance` is corrected. The Cython
+        and Numba kernels implement the same function.
+
+        Note: This is a deformed trackball-- this is a trackball in the
+        center, but is deformed into a hyperbolic sheet of rotation away
+        from the center.  This particular function was chosen after trying
+        out several variations.
+    """
+
+    qx, qy, qz, qw = 0.0, 0.0, 0.0, 1.0
+    if dx or dy:
+        lz = _project(tbsize, x, y)
+        nx, ny = x + dx, y + dy
+        nz = _project(tbsize, nx, ny)
+        # Axis is new x last, angle follows from the length of last - new
+        ax = ny * lz - nz * y
+        ay = nz * x - nx * lz
+        az = nx * y - ny * x
+        dz = lz - nz
+        t = math.sqrt(dx * dx + dy * dy + dz * dz) * inv_2tb
+        if t > 1.0:
+            t = 1.0
+        if t < -1.0:
+            t = -1.0
+        half = math.asin(t)
+        s = math.sin(half)
+        n2 = ax * ax + ay * ay + az * az
+        if n2 != 0.0:
+            s /= math.sqrt(n2)
+        qx, qy, qz, qw = ax * s, ay * s, az * s, math.cos(half)
 
+    # Compose with the current rotation (see _q_add), dropping z
+    x2, y2, z2, w2 = rx, ry, rz, rw
+    rx = qw * x2 + qx * w2 + y2 * qz - z2 * qy
+    ry = qw * y2 + qy * w2 + z2 * qx - x2 * qz
+    rw = qw * w2 - qx * x2 - qy * y2 - qz * z2
 
-def _q_length(q):
-    return math.sqrt(_q_dot(q, q))
+    # Pull back towards unit length with one Newton step of 1/sqrt(|q|^2)
+    n2 = rx * rx + ry * ry + rw * rw
+    if abs(n2 - 1.0) > tolerance:
+        s = 1.5 - 0.5 * n2
+        rx *= s
+        ry *= s
+        rw *= s
+    return rx, ry, 0.0, rw
 
 
-def _q_normalize(q):
-    try:
-        return _q_mul(q, 1.0 / _q_length(q))
-    except ZeroDivisionError:
-        return q
-
-
-def _q_from_axis_angle(v, phi):
-    q = _v_mul(_v_normalize(v), math.sin(phi / 2.0))
-    q.append(math.cos(phi / 2.0))
-    return q
-
-
-def _q_rotmatrix(q):
-    m = [0.0] * 16
-    m[0*4+0] = 1.0 - 2.0 * (q[1] * q[1] + q[2] * q[2])
-    m[0*4+1] = 2.0 * (q[0] * q[1] - q[2] * q[3])
-    m[0*4+2] = 2.0 * (q[2] * q[0] + q[1] * q[3])
-    m[0*4+3] = 0.0
-    m[1*4+0] = 2.0 * (q[0] * q[1] + q[2] * q[3])
-    m[1*4+1] = 1.0 - 2.0 * (q[2] * q[2] + q[0] * q[0])
-    m[1*4+2] = 2.0 * (q[1] * q[2] - q[0] * q[3])
-    m[1*4+3] = 0.0
-    m[2*4+0] = 2.0 * (q[2] * q[0] - q[1] * q[3])
-    m[2*4+1] = 2.0 * (q[1] * q[2] + q[0] * q[3])
-    m[2*4+2] = 1.0 - 2.0 * (q[1] * q[1] + q[0] * q[0])
-    m[3*4+3] = 1.0
-    return m
+_drag_step = _compiled_drag_step() or _fused_drag
 
 
 class Trackball:
     """ Virtual trackball for 3D scene viewing. """
 
+    __slots__ = ('_rx', '_ry', '_rz', '_rw', '_zoom', '_distance', '_viewport',
+                 '_matrix', '_matrix_dirty', '_projection', '_projection_dirty',
+                 '_modelview', '_TRACKBALLSIZE', '_inv_2tb', '_theta', '_phi',
+                 '_orientation_dirty', '_x', '_y')
+
     def __init__(self, theta=0, phi=0, zoom=1, distance=3):
         """ Build a new trackball with specified view """
 
-        self._rotation = [0, 0, 0, 1]
+        self._rx, self._ry, self._rz, self._rw = 0.0, 0.0, 0.0, 1.0
         self._zoom = zoom
         self._distance = distance
-        self._count = 0
-        self._matrix = None
-        self._RENORMCOUNT = 97
-        self._TRACKBALLSIZE = 0.8
+        self._viewport = (0, 0, 1, 1)
+        self._matrix = (GLfloat * 16)()
+        self._matrix_dirty = True
+        self._projection = (GLfloat * 16)()
+        self._projection_dirty = True
+        self._modelview = (GLfloat * 16)()
+        self._TRACKBALLSIZE = _TRACKBALLSIZE
+        self._inv_2tb = 1.0 / (2.0 * self._TRACKBALLSIZE)
         self._theta = theta
         self._phi = phi
+        self._orientation_dirty = True
         self._set_orientation(theta, phi)
         self._x = 0.0
         self._y = 0.0
 
+    def set_viewport(self, width, height):
+        """ Set the viewport size, to be called whenever the window is resized """
+        if width <= 0 or height <= 0:
+            return
+        self._viewport = (0, 0, width, height)
+        self._projection_dirty = True
+
     def drag_to(self, x, y, dx, dy):
         """ Move trackball view from x,y to x+dx,y+dy. """
-        viewport = gl.glGetIntegerv(gl.GL_VIEWPORT)
-        width, height = float(viewport[2]), float(viewport[3])
-        x = (x * 2.0 - width) / width
-        dx = (2.0 * dx) / width
-        y = (y * 2.0 - height) / height
-        dy = (2.0 * dy) / height
-        q = self._rotate(x, y, dx, dy)
-        self._rotation = _q_add(q, self._rotation)
-        self._rotation[2] = 0.0
-        self._count += 1
-        if self._count > self._RENORMCOUNT:
-            self._rotation = _q_normalize(self._rotation)
-            self._count = 0
-        m = _q_rotmatrix(self._rotation)
-        self._matrix = (GLfloat * len(m))(*m)
+        width, height = float(self._viewport[2]), float(self._viewport[3])
+        self._rx, self._ry, self._rz, self._rw = _drag_step(
+            self._rx, self._ry, self._rz, self._rw,
+            (x * 2.0 - width) / width, (y * 2.0 - height) / height,
+            (2.0 * dx) / width, (2.0 * dy) / height, self._TRACKBALLSIZE,
+            self._inv_2tb, _RENORM_TOLERANCE)
+        self._orientation_dirty = True
+        self._matrix_dirty = True
 
     def zoom_to(self, x, y, dx, dy):
         """ Zoom trackball by a factor dy """
-        viewport = gl.glGetIntegerv(gl.GL_VIEWPORT)
+        viewport = self._viewport
         height = float(viewport[3])
         self.zoom = self.zoom - 5 * dy / height
 
@@ -175,25 +270,12 @@ class Trackball:
         self._y += dy * 0.1
 
     def push(self):
-        viewport = gl.glGetIntegerv(gl.GL_VIEWPORT)
         gl.glMatrixMode(gl.GL_PROJECTION)
         gl.glPushMatrix()
-        gl.glLoadIdentity()
-        aspect = viewport[2] / float(viewport[3])
-        aperture = 35.0
-        near = 0.1
-        far = 100.0
-        top = math.tan(aperture * math.pi / 360.0) * near * self._zoom
-        bottom = -top
-        left = aspect * bottom
-        right = aspect * top
-        gl.glFrustum(left, right, bottom, top, near, far)
+        gl.glLoadMatrixf(self._update_projection())
         gl.glMatrixMode(gl.GL_MODELVIEW)
         gl.glPushMatrix()
-        gl.glLoadIdentity()
-        # gl.glTranslate (0.0, 0, -self._distance)
-        gl.glTranslate(self._x, self._y, -self._distance)
-        gl.glMultMatrixf(self._matrix)
+        gl.glLoadMatrixf(self._update_modelview())
 
     @staticmethod
     def pop():
@@ -204,7 +286,7 @@ class Trackball:
 
     @property
     def matrix(self):
-        return self._matrix
+        return self._update_matrix()
 
     @property
     def zoom(self):
@@ -217,6 +299,7 @@ class Trackball:
             self._zoom = .25
         if self._zoom > 10.0:
             self._zoom = 10.0
+        self._projection_dirty = True
 
     @property
     def distance(self):
@@ -230,8 +313,7 @@ class Trackball:
 
     @property
     def theta(self):
-        self._theta, self._phi = self._get_orientation()
-        return self._theta
+        return self._get_orientation()[0]
 
     @theta.setter
     def theta(self, theta):
@@ -239,75 +321,79 @@ class Trackball:
 
     @property
     def phi(self):
-        self._theta, self._phi = self._get_orientation()
-        return self._phi
+        return self._get_orientation()[1]
 
     @phi.setter
     def phi(self, phi):
         self._set_orientation(math.fmod(self._theta, 360.0), math.fmod(phi, 360.0))
 
     def _get_orientation(self):
-        """ Return current computed orientation (theta,phi). """ 
+        """ Return current computed orientation (theta,phi), cached until the
+            rotation changes.
+        """
 
-        q0, q1, q2, q3 = self._rotation
-        ax = math.atan(2 * (q0 * q1 + q2 * q3) / (1 - 2 * (q1 * q1 + q2 * q2))) * 180.0 / math.pi
-        az = math.atan(2 * (q0 * q3 + q1 * q2) / (1 - 2 * (q2 * q2 + q3 * q3))) * 180.0 / math.pi
-        return -az, ax
+        if self._orientation_dirty:
+            x, y, z, w = self._rx, self._ry, self._rz, self._rw
+            xx, yy, zz, ww = x * x, y * y, z * z, w * w
+            self._theta = math.atan2(2 * (x * w + y * z), ww + zz - xx - yy) * _RAD2DEG
+            self._phi = math.atan2(2 * (x * y + z * w), ww + xx - yy - zz) * _RAD2DEG
+            self._orientation_dirty = False
+        return self._theta, self._phi
 
     def _set_orientation(self, theta, phi):
         """ Computes rotation corresponding to theta and phi. """ 
 
         self._theta = theta
         self._phi = phi
-        angle = self._theta*(math.pi/180.0)
-        sine = math.sin(0.5*angle)
-        xrot = [1 * sine, 0, 0, math.cos(0.5 * angle)]
-        angle = self._phi * (math.pi / 180.0)
-        sine = math.sin(0.5 * angle)
-        zrot = [0, 0, sine, math.cos(0.5 * angle)]
-        self._rotation = _q_add(xrot, zrot)
-        m = _q_rotmatrix(self._rotation)
-        self._matrix = (GLfloat * len(m))(*m)
-
-    @staticmethod
-    def _project(r, x, y):
-        """ Project an x,y pair onto a sphere of radius r OR a hyperbolic sheet
-            if we are away from the center of the sphere.
+        angle = self._theta * _DEG2RAD
+        xsine, xcos = math.sin(0.5 * angle), math.cos(0.5 * angle)
+        angle = self._phi * _DEG2RAD
+        zsine, zcos = math.sin(0.5 * angle), math.cos(0.5 * angle)
+        self._rx, self._ry, self._rz, self._rw = _q_add(xsine, 0.0, 0.0, xcos, 0.0, 0.0, zsine, zcos)
+        self._orientation_dirty = True
+        self._matrix_dirty = True
+
+    def _update_matrix(self):
+        """ Rebuild the rotation matrix if the rotation changed since the last
+            read, and return it.
         """
 
-        d = math.sqrt(x * x + y * y)
-        if d < r * 0.70710678118654752440:    # Inside sphere
-            z = math.sqrt(r * r - d * d)
-        else:                                   # On hyperbola
-            t = r / 1.41421356237309504880
-            z = t * t / d
-        return z
-
-    def _rotate(self, x, y, dx, dy): 
-        """ Simulate a track-ball.
-
-            Project the points onto the virtual trackball, then figure out the
-            axis of rotation, which is the cross product of x,y and x+dx,y+dy.
+        if self._matrix_dirty:
+            struct.pack_into('16f', self._matrix, 0, *_q_rotmatrix(self._rx, self._ry, self._rz, self._rw))
+            self._matrix_dirty = False
+        return self._matrix
 
-            Note: This is a deformed trackball-- this is a trackball in the
-            center, but is deformed into a hyperbolic sheet of rotation away
-            from the center.  This particular function was chosen after trying
-            out several variations.
+    def _update_projection(self):
+        """ Rebuild the glFrustum projection matrix if zoom or viewport changed
+            since the last read, and return it.
         """
 
-        if not dx and not dy:
-            return [0.0, 0.0, 0.0, 1.0]
-        last = [x, y, self._project(self._TRACKBALLSIZE, x, y)]
-        new = [x + dx, y + dy, self._project(self._TRACKBALLSIZE, x + dx, y + dy)]
-        a = _v_cross(new, last)
-        d = _v_sub(last, new)
-        t = _v_length(d) / (2.0 * self._TRACKBALLSIZE)
-        if t > 1.0:
-            t = 1.0
-        if t < -1.0:
-            t = -1.0
-        phi = 2.0 * math.asin(t)
-        return _q_from_axis_angle(a, phi)
+        if self._projection_dirty:
+            viewport = self._viewport
+            aspect = viewport[2] / float(viewport[3])
+            aperture = 35.0
+            near = 0.1
+            far = 100.0
+            top = math.tan(aperture * math.pi / 360.0) * near * self._zoom
+            right = aspect * top
+            # Symmetric glFrustum(-right, right, -top, top, near, far)
+            struct.pack_into('16f', self._projection, 0,
+                             near / right, 0.0, 0.0, 0.0,
+                             0.0, near / top, 0.0, 0.0,
+                             0.0, 0.0, -(far + near) / (far - near), -1.0,
+                             0.0, 0.0, -2.0 * far * near / (far - near), 0.0)
+            self._projection_dirty = False
+        return self._projection
+
+    def _update_modelview(self):
+        """ Return translate(x, y, -distance) * rotation as a single matrix. """
+
+        m = self._modelview
+        # The rotation has no translation, so the product only replaces the
+        # last column
+        ctypes.memmove(m, self._update_matrix(), 12 * ctypes.sizeof(GLfloat))
+        m[12], m[13], m[14], m[15] = self._x, self._y, -self._distance, 1.0
+        return m
 
     def __str__(self):
         return self.__repr__()
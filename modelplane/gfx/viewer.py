@@ -34,6 +34,7 @@ class Viewer:
         self._init_opengl(width, height)
         self._scene = self._init_scene()
         self._interaction = self._init_interaction(self._window)
+        self._update_trackball_viewports(width, height)
         self._shader = Shader('gfx/shader/viewer_shader.vert', 'gfx/shader/viewer_shader.frag')
 
     def main_loop(self):
@@ -133,12 +134,18 @@ class Viewer:
         if window is None or width < 0 or height < 0:
             return
         glViewport(0, 0, width, height)
+        self._update_trackball_viewports(width, height)
         self._shader['u_projection'] = Matrix44.perspective_projection(
             self._DEFAULT_FOV, float(width) / float(height), self._DEFAULT_NEAR_PLANE, self._DEFAULT_FAR_PLANE) * \
             Matrix44.from_translation(Vector4([0.0, 0.0, -self._interaction.camera().distance, 0.0]))
         self._last_width = width
         self._last_height = height
 
+    def _update_trackball_viewports(self, width, height):
+        for camera in self._interaction.cameras:
+            if camera.trackball is not None:
+                camera.trackball.set_viewport(width, height)
+
     def _window_error_callback(self, issue, info):
         glfw.destroy_window(self._window)
         glfw.terminate()